@@ -1,9 +1,183 @@
+import abc
+import torch
 from torch.utils.data import Dataset
 from cmib.lafan1 import extract, utils
 import numpy as np
 import pickle
 import os
-class LAFAN1Dataset(Dataset):
+from functools import cached_property
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, utils.quat_fk is used without it
+    njit = None
+
+# Bump when the layout of the processed data changes to invalidate old caches.
+_FORMAT_VERSION = 6
+
+# Fields that are the same array as another field. They are stored once.
+_ALIASES = {"q_target": "local_q_offset"}
+
+# Processed data already loaded in this process, keyed on its directory and
+# settings.
+_CACHE = {}
+
+
+if njit is not None:
+
+    # Serial on purpose: a parallel kernel would start a numba thread pool in the
+    # training process, which is not safe to fork into DataLoader workers.
+    @njit(fastmath=True)
+    def _fk_fused(lrot, lpos, parents, out_rot, out_pos, out_root_p):
+        """
+        Same as utils.quat_fk for (N, T, J, 4) / (N, T, J, 3) inputs, with the
+        quaternion product and rotation written out per scalar. The global
+        rotations, global positions and root trajectory are written straight into
+        the preallocated outputs in a single pass; joints follow the kinematic
+        chain.
+        """
+        N, T, J = lrot.shape[0], lrot.shape[1], lrot.shape[2]
+        for n in range(N):
+            for t in range(T):
+                out_rot[n, t, 0] = lrot[n, t, 0]
+                out_pos[n, t, 0] = lpos[n, t, 0]
+                out_root_p[n, t] = lpos[n, t, 0]
+                for j in range(1, J):
+                    p = parents[j]
+                    x0, x1, x2, x3 = out_rot[n, t, p, 0], out_rot[n, t, p, 1], out_rot[n, t, p, 2], out_rot[n, t, p, 3]
+                    y0, y1, y2, y3 = lrot[n, t, j, 0], lrot[n, t, j, 1], lrot[n, t, j, 2], lrot[n, t, j, 3]
+                    out_rot[n, t, j, 0] = y0 * x0 - y1 * x1 - y2 * x2 - y3 * x3
+                    out_rot[n, t, j, 1] = y0 * x1 + y1 * x0 - y2 * x3 + y3 * x2
+                    out_rot[n, t, j, 2] = y0 * x2 + y1 * x3 + y2 * x0 - y3 * x1
+                    out_rot[n, t, j, 3] = y0 * x3 - y1 * x2 + y2 * x1 + y3 * x0
+
+                    # Rotate the local offset by the parent's global rotation
+                    v0, v1, v2 = lpos[n, t, j, 0], lpos[n, t, j, 1], lpos[n, t, j, 2]
+                    t0 = 2.0 * (x2 * v2 - x3 * v1)
+                    t1 = 2.0 * (x3 * v0 - x1 * v2)
+                    t2 = 2.0 * (x1 * v1 - x2 * v0)
+                    out_pos[n, t, j, 0] = v0 + x0 * t0 + (x2 * t2 - x3 * t1) + out_pos[n, t, p, 0]
+                    out_pos[n, t, j, 1] = v1 + x0 * t1 + (x3 * t0 - x1 * t2) + out_pos[n, t, p, 1]
+                    out_pos[n, t, j, 2] = v2 + x0 * t2 + (x1 * t1 - x2 * t0) + out_pos[n, t, p, 2]
+
+
+def _global_fk(lrot, lpos, parents):
+    """
+    Global rotations, global positions and root positions as float32 arrays.
+    """
+    if njit is None:
+        global_rot, global_pos = utils.quat_fk(lrot, lpos, parents)
+        global_rot = global_rot.astype(np.float32)
+        global_pos = global_pos.astype(np.float32)
+        return global_rot, global_pos, np.ascontiguousarray(global_pos[:, :, 0])
+
+    N, T, J = lrot.shape[:3]
+    global_rot = np.empty((N, T, J, 4), dtype=np.float32)
+    global_pos = np.empty((N, T, J, 3), dtype=np.float32)
+    root_p = np.empty((N, T, 3), dtype=np.float32)
+    _fk_fused(
+        np.ascontiguousarray(lrot),
+        np.ascontiguousarray(lpos),
+        np.asarray(parents),
+        global_rot,
+        global_pos,
+        root_p,
+    )
+    return global_rot, global_pos, root_p
+
+
+def _bvh_signature(bvh_folder):
+    """
+    Name, size and modification time of every BVH file in bvh_folder. Unlike the
+    folder's own mtime this also changes when a file is edited in place.
+    """
+    sig = []
+    for entry in sorted(os.scandir(bvh_folder), key=lambda e: e.name):
+        if entry.name.endswith(".bvh"):
+            st = entry.stat()
+            sig.append((entry.name, st.st_size, st.st_mtime_ns))
+    return tuple(sig)
+
+
+def _is_processed(processed_dir, sig):
+    meta_path = os.path.join(processed_dir, "meta.pkl")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, "rb") as f:
+        return pickle.load(f).get("sig") == sig
+
+
+def _replace_file(path, write):
+    """
+    Call write on a temporary file next to path, then move it over path. Memory
+    maps of the previous file keep its contents instead of being truncated.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _save_processed(processed_dir, sig, data, keys):
+    """
+    Write every field to its own .npy file so that it can be memory-mapped.
+    meta.pkl is written last: an interrupted run never looks like a valid cache.
+    """
+    os.makedirs(processed_dir, exist_ok=True)
+    # Arrays mapped from the old files stay valid, but must not be handed out again
+    for key in [key for key in _CACHE if key[0] == processed_dir]:
+        del _CACHE[key]
+    meta_path = os.path.join(processed_dir, "meta.pkl")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for k in keys:
+        if k not in _ALIASES:
+            _replace_file(
+                os.path.join(processed_dir, f"{k}.npy"), lambda f: np.save(f, data[k])
+            )
+    # Small non-sample entries (seq_names, stats) live in meta.pkl
+    meta = {k: v for k, v in data.items() if k not in keys}
+    meta["sig"] = sig
+    _replace_file(meta_path, lambda f: pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL))
+
+
+def _load_processed(processed_dir, keys):
+    """
+    Map the processed fields read-only. DataLoader workers share the page cache
+    instead of each holding a private copy of the dataset. Returns the per-sample
+    arrays and the meta entries (seq_names, stats) separately.
+    """
+    with open(os.path.join(processed_dir, "meta.pkl"), "rb") as f:
+        meta = pickle.load(f)
+    data = {
+        k: np.load(os.path.join(processed_dir, f"{k}.npy"), mmap_mode="r")
+        for k in keys
+        if k not in _ALIASES
+    }
+    for k, src in _ALIASES.items():
+        data[k] = data[src]
+    meta.pop("sig")
+    return data, meta
+
+
+class LafanBase(Dataset, abc.ABC):
+    """
+    Shared body of the LAFAN-style datasets. Subclasses only choose which actors
+    are used and the offset between sliding windows.
+    """
+
+    # Stored per-sample fields; root_v is derived from root_p in __getitem__
+    _keys = (
+        "local_q",
+        "local_q_offset",
+        "q_target",
+        "root_p_offset",
+        "root_p",
+        "contact",
+        "global_pos",
+        "global_rot",
+    )
+
     def __init__(
         self,
         lafan_path: str,
@@ -16,51 +190,53 @@ class LAFAN1Dataset(Dataset):
         self.lafan_path = lafan_path
 
         self.train = train
-        # 4.3: It contains actions performedby 5 subjects, with Subject 5 used as the test set.
         self.dataset = dataset
+        self.actors = self._actors(train)
 
-        if self.dataset == 'LAFAN':
-            self.actors = (
-                ["subject1", "subject2", "subject3", "subject4"] if train else ["subject5"]
-            )
-        elif self.dataset in ['HumanEva', 'PosePrior']:
-            self.actors = (
-                ["subject1", "subject2"] if train else ["subject3"]
-            )
-        elif self.dataset in ['HUMAN4D']:
-            self.actors = (
-                ["subject1", "subject2", "subject3", "subject4", "subject5", "subject6", "subject7"] if train else ["subject8"]
-            )
-        elif self.dataset == 'MPI_HDM05':
-            self.actors = (
-                ["subject1", "subject2", "subject3"] if train else ["subject4"]
-            )
-        else:
-            ValueError("Invalid Dataset")
-        
         # 4.3: ... The training statistics for normalization are computed on windows of 50 frames offset by 20 frames.
         self.window = window
 
-        # 4.3: Given the larger size of ... we sample our test windows from Subject 5 at every 40 frames.
-        # The training statistics for normalization are computed on windows of 50 frames offset by 20 frames.
-        self.offset = 20 if self.train else 40
+        self.offset = self._offset(train)
 
         self.device = device
 
-        pickle_name = "processed_train_data.pkl" if train else "processed_test_data.pkl"
-        """
-        if pickle_name in os.listdir(processed_data_dir):
-            with open(os.path.join(processed_data_dir, pickle_name), "rb") as f:
-                self.data = pickle.load(f)
-        else:
-        """
-        self.data = self.load_lafan()  # Call this last
-        with open(os.path.join(processed_data_dir, pickle_name), "wb") as f:
-            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        processed_dir = os.path.join(processed_data_dir, "train" if train else "test")
+        # Reuse the processed data only if it was built with the same settings
+        # and none of the BVH files has changed since.
+        sig = (
+            _FORMAT_VERSION,
+            self.lafan_path,
+            _bvh_signature(self.lafan_path),
+            tuple(sorted(self.actors)),
+            self.window,
+            self.offset,
+            self.dataset,
+        )
+        # A second dataset built with the same settings reuses the loaded arrays.
+        cache_key = (processed_dir, sig)
+        if cache_key not in _CACHE:
+            if not _is_processed(processed_dir, sig):
+                _save_processed(processed_dir, sig, self.load_lafan(), self._keys)  # Call this last
+            _CACHE[cache_key] = _load_processed(processed_dir, self._keys)
+        self._bind(*_CACHE[cache_key])
+
+    def _bind(self, data, meta):
+        self.data = data
+        self.meta = meta
+        # (key, array) pairs, so __getitem__ does no dict lookups
+        self._arrs = tuple((k, data[k]) for k in self._keys)
+
+    @abc.abstractmethod
+    def _actors(self, train):
+        """Actors whose BVH files make up the split."""
+
+    @abc.abstractmethod
+    def _offset(self, train):
+        """Frame offset between consecutive windows."""
 
     @property
     def root_v_dim(self):
-        return self.data["root_v"].shape[2]
+        return self.data["root_p"].shape[2]
 
     @property
     def local_q_dim(self):
@@ -74,9 +250,12 @@ class LAFAN1Dataset(Dataset):
     def num_joints(self):
         return self.data["global_pos"].shape[2]
 
-    @property
+    @cached_property
     def global_pos_std(self):
-        return torch.Tensor(self.data["global_pos"].std(axis=(0, 1))).to(self.device)
+        return torch.from_numpy(self.meta["_global_pos_std"]).to(self.device)
+
+    def get_seq_name(self, index):
+        return self.meta["seq_names"][index]
 
 
     def load_lafan(self):
@@ -88,153 +267,69 @@ class LAFAN1Dataset(Dataset):
         )
 
         # Retrieve global representations. (global quaternion, global positions)
-        global_rot, global_pos = utils.quat_fk(Q, X, parents)
+        global_rot, global_pos, root_p = _global_fk(Q, X, parents)
 
         input_data = {}
         input_data["local_q"] = Q  # q_{t}
         input_data["local_q_offset"] = Q[:, -1, :, :]  # lasst frame's quaternions
-        input_data["q_target"] = Q[:, -1, :, :]  # q_{T}
+        input_data["q_target"] = input_data["local_q_offset"]  # q_{T}, same array
         input_data["global_rot"] = global_rot
-        input_data["root_v"] = (
-            global_pos[:, 1:, 0, :] - global_pos[:, :-1, 0, :]
-        )  # \dot{r}_{t}
         input_data["root_p_offset"] = global_pos[
             :, -1, 0, :
         ]  # last frame's root positions
-        input_data["root_p"] = global_pos[:, :, 0, :]
+        # root_v is not stored; __getitem__ derives it from the root_p sample
+        input_data["root_p"] = root_p
 
         input_data["contact"] = np.concatenate(
             [contacts_l, contacts_r], -1
         )  # Foot contact
-        input_data["global_pos"] = global_pos[
-            :, :, :, :
-        ]  # global position (N, 50, 22, 30) why not just global_pos
+        input_data["global_pos"] = global_pos  # global position (N, 50, 22, 30)
         input_data["seq_names"] = seq_names
+
+        # Cast once here so that __getitem__ is pure slicing.
+        for k in self._keys:
+            if k not in _ALIASES:
+                input_data[k] = np.ascontiguousarray(input_data[k], dtype=np.float32)
+        for k, src in _ALIASES.items():
+            input_data[k] = input_data[src]
+        input_data["_global_pos_std"] = input_data["global_pos"].std(axis=(0, 1))
         return input_data
 
     def __len__(self):
         return self.data["global_pos"].shape[0]
 
     def __getitem__(self, index):
-        query = {}
-        query["local_q"] = self.data["local_q"][index].astype(np.float32)
-        query["local_q_offset"] = self.data["local_q_offset"][index].astype(np.float32)
-        query["q_target"] = self.data["q_target"][index].astype(np.float32)
-        query["root_v"] = self.data["root_v"][index].astype(np.float32)
-        query["root_p_offset"] = self.data["root_p_offset"][index].astype(np.float32)
-        query["root_p"] = self.data["root_p"][index].astype(np.float32)
-        query["contact"] = self.data["contact"][index].astype(np.float32)
-        query["global_pos"] = self.data["global_pos"][index].astype(np.float32)
-        query["global_rot"] = self.data["global_rot"][index].astype(np.float32)
+        # Copy the sample out of the read-only memory map once
+        query = {k: np.array(a[index]) for k, a in self._arrs}
+        root_p = query["root_p"]
+        query["root_v"] = root_p[1:] - root_p[:-1]  # \dot{r}_{t}
         return query
 
-class CustomDataset(Dataset):
-    def __init__(
-        self,
-        lafan_path: str,
-        processed_data_dir: str,
-        train: bool,
-        device: str,
-        window: int = 65,
-        dataset: str = 'LAFAN'
-    ):
-        self.lafan_path = lafan_path
 
-        self.train = train
+class LAFAN1Dataset(LafanBase):
+    def _actors(self, train):
         # 4.3: It contains actions performedby 5 subjects, with Subject 5 used as the test set.
-        self.dataset = dataset
-
-        self.actors = (
-            [str(i).zfill(3) if i < 10 else str(i).zfill(4) for i in range(0, 16)] if train else ["0015"]
-        )
-        
-        # 4.3: ... The training statistics for normalization are computed on windows of 50 frames offset by 20 frames.
-        self.window = window
+        if self.dataset == 'LAFAN':
+            return ["subject1", "subject2", "subject3", "subject4"] if train else ["subject5"]
+        elif self.dataset in ['HumanEva', 'PosePrior']:
+            return ["subject1", "subject2"] if train else ["subject3"]
+        elif self.dataset in ['HUMAN4D']:
+            return ["subject1", "subject2", "subject3", "subject4", "subject5", "subject6", "subject7"] if train else ["subject8"]
+        elif self.dataset == 'MPI_HDM05':
+            return ["subject1", "subject2", "subject3"] if train else ["subject4"]
+        else:
+            raise ValueError("Invalid Dataset")
 
+    def _offset(self, train):
         # 4.3: Given the larger size of ... we sample our test windows from Subject 5 at every 40 frames.
         # The training statistics for normalization are computed on windows of 50 frames offset by 20 frames.
-        #self.offset = 20 if self.train else 40
-        self.offset = 5
+        return 20 if train else 40
 
-        self.device = device
-
-        pickle_name = "processed_train_data.pkl" if train else "processed_test_data.pkl"
-        """
-        if pickle_name in os.listdir(processed_data_dir):
-            with open(os.path.join(processed_data_dir, pickle_name), "rb") as f:
-                self.data = pickle.load(f)
-        else:
-        """
-        self.data = self.load_lafan()  # Call this last
-        with open(os.path.join(processed_data_dir, pickle_name), "wb") as f:
-            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
-
-    @property
-    def root_v_dim(self):
-        return self.data["root_v"].shape[2]
-
-    @property
-    def local_q_dim(self):
-        return self.data["local_q"].shape[2] * self.data["local_q"].shape[3]
-
-    @property
-    def contact_dim(self):
-        return self.data["contact"].shape[2]
 
-    @property
-    def num_joints(self):
-        return self.data["global_pos"].shape[2]
+class CustomDataset(LafanBase):
+    def _actors(self, train):
+        return [str(i).zfill(3) if i < 10 else str(i).zfill(4) for i in range(0, 16)] if train else ["0015"]
 
-    @property
-    def global_pos_std(self):
-        return torch.Tensor(self.data["global_pos"].std(axis=(0, 1))).to(self.device)
-
-
-    def load_lafan(self):
-        # This uses method provided with LAFAN1.
-        # X and Q are local position/quaternion. Motions are rotated to make 10th frame facing X+ position.
-        # Refer to paper 3.1 Data formatting
-        X, Q, parents, contacts_l, contacts_r, seq_names = extract.get_lafan1_set(
-            self.lafan_path, self.actors, self.window, self.offset, self.train, self.dataset
-        )
-
-        # Retrieve global representations. (global quaternion, global positions)
-        global_rot, global_pos = utils.quat_fk(Q, X, parents)
-
-        input_data = {}
-        input_data["local_q"] = Q  # q_{t}
-        input_data["local_q_offset"] = Q[:, -1, :, :]  # lasst frame's quaternions
-        input_data["q_target"] = Q[:, -1, :, :]  # q_{T}
-        input_data["global_rot"] = global_rot
-        input_data["root_v"] = (
-            global_pos[:, 1:, 0, :] - global_pos[:, :-1, 0, :]
-        )  # \dot{r}_{t}
-        input_data["root_p_offset"] = global_pos[
-            :, -1, 0, :
-        ]  # last frame's root positions
-        input_data["root_p"] = global_pos[:, :, 0, :]
-
-        input_data["contact"] = np.concatenate(
-            [contacts_l, contacts_r], -1
-        )  # Foot contact
-        input_data["global_pos"] = global_pos[
-            :, :, :, :
-        ]  # global position (N, 50, 22, 30) why not just global_pos
-        input_data["seq_names"] = seq_names
-        return input_data
-
-    def __len__(self):
-        return self.data["global_pos"].shape[0]
-
-    def __getitem__(self, index):
-        query = {}
-        query["local_q"] = self.data["local_q"][index].astype(np.float32)
-        query["local_q_offset"] = self.data["local_q_offset"][index].astype(np.float32)
-        query["q_target"] = self.data["q_target"][index].astype(np.float32)
-        query["root_v"] = self.data["root_v"][index].astype(np.float32)
-        query["root_p_offset"] = self.data["root_p_offset"][index].astype(np.float32)
-        query["root_p"] = self.data["root_p"][index].astype(np.float32)
-        query["contact"] = self.data["contact"][index].astype(np.float32)
-        query["global_pos"] = self.data["global_pos"][index].astype(np.float32)
-        query["global_rot"] = self.data["global_rot"][index].astype(np.float32)
-        return query
\ No newline at end of file
+    def _offset(self, train):
+        #return 20 if train else 40
+        return 5
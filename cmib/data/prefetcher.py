@@ -0,0 +1,71 @@
+import torch
+
+
+def _apply(fn, batch):
+    """
+    Apply fn to every tensor of a (possibly nested) batch: tensor, dict, list,
+    tuple or namedtuple.
+    """
+    if torch.is_tensor(batch):
+        return fn(batch)
+    if isinstance(batch, dict):
+        return {k: _apply(fn, v) for k, v in batch.items()}
+    if isinstance(batch, tuple) and hasattr(batch, "_fields"):
+        return type(batch)(*(_apply(fn, v) for v in batch))
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_apply(fn, v) for v in batch)
+    return batch
+
+
+class CudaPrefetcher:
+    """
+    Iterate over a DataLoader while the next batch is already being copied to the
+    GPU on a side stream, so that the host-to-device copy overlaps the model step.
+
+    The copies only overlap if the batches are in pinned memory, i.e. the loader
+    was built with pin_memory=True. On a non-CUDA device batches are simply moved.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            self.next_batch = _apply(self._to_device, batch)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_batch = _apply(self._to_device, batch)
+
+    def _to_device(self, tensor):
+        return tensor.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # The tensors were allocated on the side stream; keep the caching
+            # allocator from reusing them before the main stream is done.
+            _apply(lambda t: t.record_stream(current_stream), batch)
+
+        self._preload()
+        return batch
@@ -1,5 +1,8 @@
+import functools
 import glob
+import io
 import json
+import multiprocessing
 import os
 from pathlib import Path
 import re
@@ -24,12 +27,104 @@ def write_json(filename, local_q, root_pos, joint_names):
         json.dump(json_out, outfile)
 
 
+def _check_flip(original, flipped):
+    """
+    Check the closed-form mirror of one frame of joint rotations (21, 3) against
+    the quaternion round trip it replaces: euler -> quaternion, negate w and x,
+    quaternion -> euler. Both are compared as "zxy" quaternions up to sign, since
+    the round trip may return other angles for the same rotation.
+    """
+    quat = euler_to_quaternion(np.radians(original), "zxy")
+    quat[:, 0] *= -1.0
+    quat[:, 1] *= -1.0
+    round_trip = euler_to_quaternion(np.radians(qeuler_np(quat, "zxy")), "zxy")
+    closed_form = euler_to_quaternion(np.radians(flipped), "zxy")
+    dots = np.abs(np.sum(round_trip * closed_form, axis=-1))
+    assert np.allclose(dots, 1.0, atol=1e-4), "closed-form LR flip disagrees with the quaternion round trip"
+
+
+def _flip_one(bvh_folder: str, converting_fn: str):
+    """
+    Write the LR flipped copy of a single bvh file. Used by flip_bvh workers.
+
+    Joint rotations are mirrored in closed form. This assumes that the three
+    rotation channels of every joint are stored X, Y, Z, i.e. column 0 is the X
+    angle, and composed in "zxy" order, which is how the previous quaternion
+    round trip read them. Under that reading, negating columns 1 and 2 is an
+    exact X mirror. Files whose channels are stored in another order are not
+    mirrored exactly; for them the output also differs from the round trip
+    wherever the column-0 angle is beyond +-90 degrees.
+    """
+
+    with open(os.path.join(bvh_folder, converting_fn), "r") as file_read:
+        content = file_read.read()
+    # The "Frame Time" line is the last exact copy. Motion lines come next
+    motion_start = content.index("\n", content.index("Frame Time")) + 1
+    hierarchy, motion = content[:motion_start], content[motion_start:]
+
+    # Parse the whole motion section at once: (Frames, 23, 3)
+    # Hips 6 Channel + 3 * 21 = 69
+    motion_mat = np.loadtxt(io.StringIO(motion), ndmin=2).reshape(-1, 23, 3)
+    # Followings are very helpful to understand which axis needs to be inverted
+    # http://lo-th.github.io/olympe/BVH_player.html
+    # https://quaternions.online/
+    motion_mat[:, 0, 2] *= -1.0  # Invert translation Z axis (forward-backward)
+    # Invert X-axis (Left-Right). On quaternions (w, x, y, z) this is (w, x, -y, -z):
+    # x-rotations are kept and y/z-rotation angles are negated. With the channel
+    # layout euler_to_quaternion(..., "zxy") assumes, that keeps the first angle and
+    # negates the other two, without an euler -> quaternion -> euler round trip.
+    original = motion_mat[0, 1:].copy()
+    motion_mat[:, 1:, 1] *= -1.0
+    motion_mat[:, 1:, 2] *= -1.0
+    # One frame per file is checked against the round trip it replaces
+    _check_flip(original, motion_mat[0, 1:])
+
+    # idx 0: Hips Wolrd coord, idx 1: Hips Rotation
+    left_idx = [15, 16, 17, 18, 7, 8, 9, 10]  # From 2: LeftUpLeg... #[2, 3, 4, 5, 15, 16, 17, 18] 
+    right_idx = [19, 20, 21, 22, 11, 12, 13, 14]  # From 6: RightUpLeg... #[6, 7, 8, 9, 19, 20, 21, 22]
+    motion_mat[:, left_idx + right_idx] = motion_mat[:, right_idx + left_idx]
+
+    # Format in memory and emit the whole file with a single write
+    out = io.StringIO()
+    out.write(hierarchy)
+    np.savetxt(out, motion_mat.reshape(-1, 69), fmt="%.6f")
+    with open(
+        os.path.join(bvh_folder, converting_fn.replace(".bvh", "_LRflip.bvh")), "w"
+    ) as fout:
+        fout.write(out.getvalue())
+    return converting_fn
+
+
+def _bvh_state(bvh_folder: str):
+    """
+    Size and modification time of every bvh file in bvh_folder, by name.
+    """
+    state = {}
+    for entry in os.scandir(bvh_folder):
+        if entry.name.endswith(".bvh"):
+            st = entry.stat()
+            state[entry.name] = [st.st_size, st.st_mtime_ns]
+    return state
+
+
 def flip_bvh(bvh_folder: str, skip: str):
     """
     Generate LR flip of existing bvh files. Assumes Z-forward.
     It does not flip files contains skip string in their name.
+
+    A completed pass records the skip string and the size and mtime of every
+    bvh file in a sentinel file in bvh_folder. Later calls return immediately
+    while both still match.
     """
 
+    sentinel = Path(bvh_folder) / ".flipped"
+    if sentinel.exists():
+        with open(sentinel) as f:
+            flipped = json.load(f)
+        if flipped == {"skip": skip, "files": _bvh_state(bvh_folder)}:
+            print("Left-Right Flipping Process... [SKIP] (already flipped)")
+            return
+
     print("Left-Right Flipping Process...")
 
     # List files which are not flipped yet
@@ -37,7 +132,7 @@ def flip_bvh(bvh_folder: str, skip: str):
     not_convert = []
     bvh_files = os.listdir(bvh_folder)
     for bvh_file in bvh_files:
-        if "_LRflip.bvh" in bvh_file:
+        if not bvh_file.endswith(".bvh") or "_LRflip.bvh" in bvh_file:
             continue
         if skip in bvh_file:
             not_convert.append(bvh_file)
@@ -53,50 +148,15 @@ def flip_bvh(bvh_folder: str, skip: str):
     print("Following files are not flipped: ")
     print(not_convert)
 
-    for i, converting_fn in enumerate(to_convert):
-        fout = open(
-            os.path.join(bvh_folder, converting_fn.replace(".bvh", "_LRflip.bvh")), "w"
-        )
-        file_read = open(os.path.join(bvh_folder, converting_fn), "r")
-        file_lines = file_read.readlines()
-        hierarchy_part = True
-        for line in file_lines:
-            if hierarchy_part:
-                fout.write(line)
-                if "Frame Time" in line:
-                    # This should be the last exact copy. Motion line comes next
-                    hierarchy_part = False
-            else:
-                # Followings are very helpful to understand which axis needs to be inverted
-                # http://lo-th.github.io/olympe/BVH_player.html
-                # https://quaternions.online/
-                str_to_num = line.split(" ")[:-1]  # Extract number only
-                motion_mat = np.array([float(x) for x in str_to_num]).reshape(
-                    23, 3
-                )  # Hips 6 Channel + 3 * 21 = 69
-                motion_mat[0, 2] *= -1.0  # Invert translation Z axis (forward-backward)
-                quat = euler_to_quaternion(
-                    np.radians(motion_mat[1:]), "zxy" #zyx original
-                )  # This function takes radians
-                # Invert X-axis (Left-Right) / Quaternion representation: (w, x, y, z)
-                quat[:, 0] *= -1.0
-                quat[:, 1] *= -1.0
-                motion_mat[1:] = np.degrees(qeuler_np(quat, "zxy")) #zyx original
-
-                # idx 0: Hips Wolrd coord, idx 1: Hips Rotation
-                left_idx = [15, 16, 17, 18, 7, 8, 9, 10]  # From 2: LeftUpLeg... #[2, 3, 4, 5, 15, 16, 17, 18] 
-                right_idx = [19, 20, 21, 22, 11, 12, 13, 14]  # From 6: RightUpLeg... #[6, 7, 8, 9, 19, 20, 21, 22]
-                motion_mat[left_idx + right_idx] = motion_mat[
-                    right_idx + left_idx
-                ].copy()
-                motion_mat = np.round(motion_mat, decimals=6)
-                motion_vector = np.reshape(motion_mat, (69,))
-                motion_part_str = ""
-                for s in motion_vector:
-                    motion_part_str += str(s) + " "
-                motion_part_str += "\n"
-                fout.write(motion_part_str)
-        print(f"[{i+1}/{len(to_convert)}] {converting_fn} flipped.")
+    # Files are independent, so flip them on all available cores.
+    if to_convert:
+        with multiprocessing.Pool(os.cpu_count()) as pool:
+            flip = functools.partial(_flip_one, bvh_folder)
+            for i, converting_fn in enumerate(pool.imap_unordered(flip, to_convert)):
+                print(f"[{i+1}/{len(to_convert)}] {converting_fn} flipped.")
+
+    with open(sentinel, "w") as f:
+        json.dump({"skip": skip, "files": _bvh_state(bvh_folder)}, f)
 
 
 def increment_path(path, exist_ok=False, sep="", mkdir=False):
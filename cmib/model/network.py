@@ -1,3 +1,5 @@
+from typing import Optional, Tuple
+
 import torch
 from torch import nn, Tensor
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
@@ -26,7 +28,7 @@ class TransformerModel(nn.Module):
         self.cond_emb = nn.Embedding(num_labels, d_model)
         self.pos_embedding = PositionalEmbedding(seq_len=seq_len, d_model=d_model)
         encoder_layers = TransformerEncoderLayer(
-            d_model, nhead, d_hid, dropout, activation="gelu"
+            d_model, nhead, d_hid, dropout, activation="gelu", batch_first=True
         )
         self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
         self.decoder = nn.Linear(d_model, out_dim)
@@ -38,22 +40,24 @@ class TransformerModel(nn.Module):
         self.decoder.bias.data.zero_()
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
-    def forward(self, src: Tensor, src_mask: Tensor, cond_code: Tensor) -> Tensor:
+    def forward(self, src: Tensor, src_mask: Optional[Tensor], cond_code: Tensor) -> Tuple[Tensor, Tensor]:
         """
         Args:
-            src: Tensor, shape [seq_len, batch_size, embedding_dim]
-            src_mask: Tensor, shape [seq_len, seq_len]
+            src: Tensor, shape [batch_size, seq_len, embedding_dim]
+            src_mask: Tensor, shape [seq_len, seq_len], or None to attend everywhere
+            cond_code: Tensor, shape [batch_size, 1]
 
         Returns:
-            output Tensor of shape [seq_len, batch_size, embedding_dim]
+            output Tensor of shape [batch_size, seq_len + 1, embedding_dim] and the
+            condition embedding of shape [batch_size, 1, embedding_dim]
         """
         #print(self.cond_emb(cond_code)
         #print(self.d_model)
-        cond_embedding = self.cond_emb(cond_code).permute(1, 0, 2)
+        cond_embedding = self.cond_emb(cond_code)
         #print(cond_embedding)
         #print(src.shape)
         output = self.pos_embedding(src)
-        output = torch.cat([cond_embedding, output], dim=0)
+        output = torch.cat([cond_embedding, output], dim=1)
         #print(cond_embedding.shape)
         #print(output.shape)
         #print(src_mask.shape)
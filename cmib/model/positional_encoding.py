@@ -8,14 +8,11 @@ class PositionalEmbedding(nn.Module):
         super().__init__()
         self.pos_emb = nn.Embedding(seq_len + 1, d_model)
 
-    def forward(self, inputs):
-        positions = (
-            torch.arange(inputs.size(0), device=inputs.device)
-            .expand(inputs.size(1), inputs.size(0))
-            .contiguous()
-            + 1
-        )
-        outputs = inputs + self.pos_emb(positions).permute(1, 0, 2)
+    def forward(self, inputs: Tensor) -> Tensor:
+        # Positions 1..seq_len are the same for every sequence: add that slice of
+        # the table, broadcast over the batch, instead of a per-sample lookup.
+        # inputs are batch first, [batch_size, seq_len, d_model].
+        outputs = inputs + self.pos_emb.weight[1 : inputs.size(1) + 1].unsqueeze(0)
         return outputs
 
 
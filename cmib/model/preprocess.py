@@ -4,9 +4,7 @@ import torch
 def replace_constant(minibatch_pose_input, mask_start_frame):
 
     seq_len = minibatch_pose_input.size(1)
-    interpolated = (
-        torch.ones_like(minibatch_pose_input, device=minibatch_pose_input.device) * 0.1
-    )
+    interpolated = torch.full_like(minibatch_pose_input, 0.1)
 
     if mask_start_frame == 0 or mask_start_frame == (seq_len - 1):
         interpolate_start = minibatch_pose_input[:, 0, :]
@@ -39,94 +37,104 @@ def replace_constant(minibatch_pose_input, mask_start_frame):
     return interpolated
 
 
+def _align(x, y):
+    """
+    y with the sign of every quaternion flipped where it points away from x, so
+    that interpolating from x to y takes the short way around.
+    """
+    neg = torch.sum(x * y, dim=-1, keepdim=True) < 0.0
+    return torch.where(neg, -y, y)
+
+
 def slerp(x, y, a):
     """
     Perfroms spherical linear interpolation (SLERP) between x and y, with proportion a
 
     :param x: quaternion tensor
     :param y: quaternion tensor
-    :param a: indicator (between 0 and 1) of completion of the interpolation.
+    :param a: indicator (between 0 and 1) of completion of the interpolation, a
+        float or a tensor broadcastable against x[..., 0]
     :return: tensor of interpolation results
     """
-    device = x.device
+    # Sign-aligned copy of y; the inputs are left untouched
+    y = _align(x, y)
     len = torch.sum(x * y, dim=-1)
 
-    neg = len < 0.0
-    len[neg] = -len[neg]
-    y[neg] = -y[neg]
-
-    a = torch.zeros_like(x[..., 0]) + a
-    amount0 = torch.zeros(a.shape, device=device)
-    amount1 = torch.zeros(a.shape, device=device)
+    a = torch.zeros_like(len) + a
 
+    # Both branches are evaluated densely and selected with torch.where instead
+    # of filling zero buffers through boolean masks. The slerp branch may be
+    # nan/inf where the linear one is selected; those values are discarded.
     linear = (1.0 - len) < 0.01
-    omegas = torch.arccos(len[~linear])
+    omegas = torch.arccos(len)
     sinoms = torch.sin(omegas)
 
-    amount0[linear] = 1.0 - a[linear]
-    amount0[~linear] = torch.sin((1.0 - a[~linear]) * omegas) / sinoms
-
-    amount1[linear] = a[linear]
-    amount1[~linear] = torch.sin(a[~linear] * omegas) / sinoms
+    amount0 = torch.where(linear, 1.0 - a, torch.sin((1.0 - a) * omegas) / sinoms)
+    amount1 = torch.where(linear, a, torch.sin(a * omegas) / sinoms)
     # res = amount0[..., np.newaxis] * x + amount1[..., np.newaxis] * y
     res = amount0.unsqueeze(3) * x + amount1.unsqueeze(3) * y
 
     return res
 
 
+def _ramp(num_frames, like, ndim):
+    """
+    Interpolation weights 0..1 over num_frames frames, shaped (1, num_frames, 1, ...)
+    with ndim dimensions so that they broadcast over the batch and features.
+    """
+    weights = torch.linspace(0.0, 1.0, num_frames, dtype=like.dtype, device=like.device)
+    return weights.reshape(1, num_frames, *([1] * (ndim - 2)))
+
+
 def slerp_input_repr(minibatch_pose_input, mask_start_frame):
     seq_len = minibatch_pose_input.size(1)
     minibatch_pose_input = minibatch_pose_input.reshape(
         minibatch_pose_input.size(0), seq_len, -1, 4
     )
-    interpolated = torch.zeros_like(
-        minibatch_pose_input, device=minibatch_pose_input.device
-    )
 
+    # All frames of a segment are interpolated at once, the weights broadcast
+    # over the frame axis of the (B, 1, J, 4) key quaternions.
     if mask_start_frame == 0 or mask_start_frame == (seq_len - 1):
         interpolate_start = minibatch_pose_input[:, 0:1]
-        interpolate_end = minibatch_pose_input[:, seq_len - 1 :]
+        interpolate_end = _align(interpolate_start, minibatch_pose_input[:, seq_len - 1 :])
 
-        for i in range(seq_len):
-            dt = 1 / (seq_len - 1)
-            interpolated[:, i : i + 1, :] = slerp(
-                interpolate_start, interpolate_end, dt * i
-            )
+        interpolated = slerp(
+            interpolate_start, interpolate_end, _ramp(seq_len, minibatch_pose_input, 3)
+        )
 
         assert torch.allclose(interpolated[:, 0:1], interpolate_start)
         assert torch.allclose(interpolated[:, seq_len - 1 :], interpolate_end)
     else:
         interpolate_start1 = minibatch_pose_input[:, 0:1]
-        interpolate_end1 = minibatch_pose_input[
-            :, mask_start_frame : mask_start_frame + 1
-        ]
-
-        interpolate_start2 = minibatch_pose_input[
-            :, mask_start_frame : mask_start_frame + 1
-        ]
-        interpolate_end2 = minibatch_pose_input[:, seq_len - 1 :]
-
-        for i in range(mask_start_frame + 1):
-            dt = 1 / mask_start_frame
-            interpolated[:, i : i + 1, :] = slerp(
-                interpolate_start1, interpolate_end1, dt * i
-            )
-
-        assert torch.allclose(interpolated[:, 0:1], interpolate_start1)
-        assert torch.allclose(
-            interpolated[:, mask_start_frame : mask_start_frame + 1], interpolate_end1
+        interpolate_end1 = _align(
+            interpolate_start1,
+            minibatch_pose_input[:, mask_start_frame : mask_start_frame + 1],
         )
 
-        for i in range(mask_start_frame, seq_len):
-            dt = 1 / (seq_len - mask_start_frame - 1)
-            interpolated[:, i : i + 1, :] = slerp(
-                interpolate_start2, interpolate_end2, dt * (i - mask_start_frame)
-            )
+        # The second segment starts from the sign-aligned mask start frame
+        interpolate_start2 = interpolate_end1
+        interpolate_end2 = _align(interpolate_start2, minibatch_pose_input[:, seq_len - 1 :])
 
-        assert torch.allclose(
-            interpolated[:, mask_start_frame : mask_start_frame + 1], interpolate_start2
+        interpolated1 = slerp(
+            interpolate_start1,
+            interpolate_end1,
+            _ramp(mask_start_frame + 1, minibatch_pose_input, 3),
         )
-        assert torch.allclose(interpolated[:, seq_len - 1 :], interpolate_end2)
+
+        assert torch.allclose(interpolated1[:, 0:1], interpolate_start1)
+        assert torch.allclose(interpolated1[:, -1:], interpolate_end1)
+
+        interpolated2 = slerp(
+            interpolate_start2,
+            interpolate_end2,
+            _ramp(seq_len - mask_start_frame, minibatch_pose_input, 3),
+        )
+
+        assert torch.allclose(interpolated2[:, 0:1], interpolate_start2)
+        assert torch.allclose(interpolated2[:, -1:], interpolate_end2)
+
+        # The mask start frame is shared by both segments, the second one wins
+        interpolated = torch.cat([interpolated1[:, :mask_start_frame], interpolated2], dim=1)
 
     interpolated = torch.nn.functional.normalize(interpolated, p=2.0, dim=3)
     return interpolated.reshape(minibatch_pose_input.size(0), seq_len, -1)
@@ -134,46 +142,39 @@ def slerp_input_repr(minibatch_pose_input, mask_start_frame):
 
 def lerp_input_repr(minibatch_pose_input, mask_start_frame):
     seq_len = minibatch_pose_input.size(1)
-    interpolated = torch.zeros_like(
-        minibatch_pose_input, device=minibatch_pose_input.device
-    )
 
     if mask_start_frame == 0 or mask_start_frame == (seq_len - 1):
-        interpolate_start = minibatch_pose_input[:, 0, :]
-        interpolate_end = minibatch_pose_input[:, seq_len - 1, :]
+        interpolate_start = minibatch_pose_input[:, 0:1, :]
+        interpolate_end = minibatch_pose_input[:, seq_len - 1 :, :]
 
-        for i in range(seq_len):
-            dt = 1 / (seq_len - 1)
-            interpolated[:, i, :] = torch.lerp(
-                interpolate_start, interpolate_end, dt * i
-            )
+        interpolated = torch.lerp(
+            interpolate_start, interpolate_end, _ramp(seq_len, minibatch_pose_input, 3)
+        )
 
-        assert torch.allclose(interpolated[:, 0, :], interpolate_start)
-        assert torch.allclose(interpolated[:, seq_len - 1, :], interpolate_end)
+        assert torch.allclose(interpolated[:, 0, :], interpolate_start[:, 0])
+        assert torch.allclose(interpolated[:, seq_len - 1, :], interpolate_end[:, 0])
     else:
-        interpolate_start1 = minibatch_pose_input[:, 0, :]
-        interpolate_end1 = minibatch_pose_input[:, mask_start_frame, :]
+        interpolate_start1 = minibatch_pose_input[:, 0:1, :]
+        interpolate_end1 = minibatch_pose_input[:, mask_start_frame : mask_start_frame + 1, :]
 
-        interpolate_start2 = minibatch_pose_input[:, mask_start_frame, :]
-        interpolate_end2 = minibatch_pose_input[:, -1, :]
-
-        for i in range(mask_start_frame + 1):
-            dt = 1 / mask_start_frame
-            interpolated[:, i, :] = torch.lerp(
-                interpolate_start1, interpolate_end1, dt * i
-            )
-
-        assert torch.allclose(interpolated[:, 0, :], interpolate_start1)
-        assert torch.allclose(interpolated[:, mask_start_frame, :], interpolate_end1)
+        interpolate_start2 = minibatch_pose_input[:, mask_start_frame : mask_start_frame + 1, :]
+        interpolate_end2 = minibatch_pose_input[:, -1:, :]
 
-        for i in range(mask_start_frame, seq_len):
-            dt = 1 / (seq_len - mask_start_frame - 1)
-            interpolated[:, i, :] = torch.lerp(
-                interpolate_start2, interpolate_end2, dt * (i - mask_start_frame)
-            )
+        interpolated1 = torch.lerp(
+            interpolate_start1,
+            interpolate_end1,
+            _ramp(mask_start_frame + 1, minibatch_pose_input, 3),
+        )
+        interpolated2 = torch.lerp(
+            interpolate_start2,
+            interpolate_end2,
+            _ramp(seq_len - mask_start_frame, minibatch_pose_input, 3),
+        )
+        interpolated = torch.cat([interpolated1[:, :mask_start_frame], interpolated2], dim=1)
 
-        assert torch.allclose(interpolated[:, mask_start_frame, :], interpolate_start2)
-        assert torch.allclose(interpolated[:, -1, :], interpolate_end2)
+        assert torch.allclose(interpolated[:, 0, :], interpolate_start1[:, 0])
+        assert torch.allclose(interpolated[:, mask_start_frame, :], interpolate_end1[:, 0])
+        assert torch.allclose(interpolated[:, -1, :], interpolate_end2[:, 0])
     return interpolated
 
 
@@ -200,19 +200,12 @@ class Skeleton:
         batch_size = unit_vec_rerp.size(0)
         seq_len = unit_vec_rerp.size(1)
         unit_vec_table = unit_vec_rerp.reshape(batch_size, seq_len, 22, 3)
-        global_position = torch.zeros_like(unit_vec_table, device=unit_vec_table.device)
 
-        for i, parent in enumerate(self._parents):
-            if parent == -1:  # if root
-                global_position[:, :, i] = unit_vec_table[:, :, i]
-
-            else:
-                global_position[:, :, i] = global_position[:, :, parent] + (
-                    nn.functional.normalize(unit_vec_table[:, :, i], p=2.0, dim=-1)
-                    * bone_length[i]
-                )
-
-        return global_position
+        # Every joint's position is the sum of the scaled offsets along its
+        # chain, i.e. one product with the ancestor matrix.
+        offsets = nn.functional.normalize(unit_vec_table, p=2.0, dim=-1) * bone_length[:, None]
+        offsets = torch.where(self._is_root[:, None], unit_vec_table, offsets)
+        return torch.matmul(self._ancestors, offsets)
 
     def convert_to_unit_offset_mat(self, global_position):
         """
@@ -221,20 +214,10 @@ class Skeleton:
         """
 
         bone_length = self.get_bone_length_weight()
-        unit_offset_mat = torch.zeros_like(
-            global_position, device=global_position.device
+        parent_position = global_position[:, :, self._parent_index].masked_fill(
+            self._is_root[:, None], 0.0
         )
-
-        for i, parent in enumerate(self._parents):
-
-            if parent == -1:  # if root
-                unit_offset_mat[:, :, i] = global_position[:, :, i]
-            else:
-                unit_offset_mat[:, :, i] = (
-                    global_position[:, :, i] - global_position[:, :, parent]
-                ) / bone_length[i]
-
-        return unit_offset_mat
+        return (global_position - parent_position) / bone_length[:, None]
 
     def remove_joints(self, joints_to_remove):
         """
@@ -269,35 +252,36 @@ class Skeleton:
         assert len(rotations.shape) == 4
         assert rotations.shape[-1] == 4
 
-        positions_world = []
         rotations_world = []
 
-        expanded_offsets = self._offsets.expand(
-            rotations.shape[0],
-            rotations.shape[1],
-            self._offsets.shape[0],
-            self._offsets.shape[1],
-        )
+        # Joint-major copy of the rotations, so that every per-joint slice below
+        # is a contiguous (N, L, 4) block rather than a view strided by J.
+        batch_shape = rotations.shape[:2]
+        num_joints = self._offsets.shape[0]
+        rotations = rotations.permute(2, 0, 1, 3).contiguous()
+
+        # Joints are written straight into the output instead of being stacked
+        positions_world = root_positions.new_empty(*batch_shape, num_joints, 3)
 
         # Parallelize along the batch and time dimensions
-        for i in range(self._offsets.shape[0]):
+        for i in range(num_joints):
             if self._parents[i] == -1:
-                positions_world.append(root_positions)
-                rotations_world.append(rotations[:, :, 0])
+                positions_world[:, :, i] = root_positions
+                rotations_world.append(rotations[0])
             else:
-                positions_world.append(
-                    qrot(rotations_world[self._parents[i]], expanded_offsets[:, :, i])
-                    + positions_world[self._parents[i]]
+                positions_world[:, :, i] = (
+                    qrot(rotations_world[self._parents[i]], self._offsets[i].expand(*batch_shape, 3))
+                    + positions_world[:, :, self._parents[i]]
                 )
                 if self._has_children[i]:
                     rotations_world.append(
-                        qmul(rotations_world[self._parents[i]], rotations[:, :, i])
+                        qmul(rotations_world[self._parents[i]], rotations[i])
                     )
                 else:
                     # This joint is a terminal node -> it would be useless to compute the transformation
                     rotations_world.append(None)
 
-        return torch.stack(positions_world, dim=3).permute(0, 1, 3, 2)
+        return positions_world
 
     def forward_kinematics_with_rotation(self, rotations, root_positions):
         """
@@ -309,52 +293,45 @@ class Skeleton:
         assert len(rotations.shape) == 4
         assert rotations.shape[-1] == 4
 
-        positions_world = []
         rotations_world = []
 
-        expanded_offsets = self._offsets.expand(
-            rotations.shape[0],
-            rotations.shape[1],
-            self._offsets.shape[0],
-            self._offsets.shape[1],
-        )
+        # Joint-major copy of the rotations, so that every per-joint slice below
+        # is a contiguous (N, L, 4) block rather than a view strided by J.
+        batch_shape = rotations.shape[:2]
+        num_joints = self._offsets.shape[0]
+        rotations = rotations.permute(2, 0, 1, 3).contiguous()
+
+        # Joints are written straight into the output instead of being stacked
+        positions_world = root_positions.new_empty(*batch_shape, num_joints, 3)
+        global_rotations = rotations.new_empty(*batch_shape, num_joints, 4)
 
         # Parallelize along the batch and time dimensions
-        for i in range(self._offsets.shape[0]):
+        for i in range(num_joints):
             if self._parents[i] == -1:
-                positions_world.append(root_positions)
-                rotations_world.append(rotations[:, :, 0])
+                positions_world[:, :, i] = root_positions
+                rotations_world.append(rotations[0])
+                global_rotations[:, :, i] = rotations[0]
             else:
-                positions_world.append(
-                    qrot(rotations_world[self._parents[i]], expanded_offsets[:, :, i])
-                    + positions_world[self._parents[i]]
+                positions_world[:, :, i] = (
+                    qrot(rotations_world[self._parents[i]], self._offsets[i].expand(*batch_shape, 3))
+                    + positions_world[:, :, self._parents[i]]
                 )
                 if self._has_children[i]:
                     rotations_world.append(
-                        qmul(rotations_world[self._parents[i]], rotations[:, :, i])
+                        qmul(rotations_world[self._parents[i]], rotations[i])
                     )
+                    global_rotations[:, :, i] = rotations_world[i]
                 else:
                     # This joint is a terminal node -> it would be useless to compute the transformation
-                    rotations_world.append(
-                        torch.Tensor([1, 0, 0, 0])
-                        .expand(rotations.shape[0], rotations.shape[1], 4)
-                        .to(rotations.device)
-                    )
+                    rotations_world.append(None)
+                    global_rotations[:, :, i] = global_rotations.new_tensor([1, 0, 0, 0])
 
-        return torch.stack(positions_world, dim=3).permute(0, 1, 3, 2), torch.stack(
-            rotations_world, dim=3
-        ).permute(0, 1, 3, 2)
+        return positions_world, global_rotations
 
     def get_bone_length_weight(self):
-        bone_length = []
-        for i, parent in enumerate(self._parents):
-            if parent == -1:
-                bone_length.append(1)
-            else:
-                bone_length.append(
-                    torch.linalg.norm(self._offsets[i : i + 1], ord="fro").item()
-                )
-        return torch.Tensor(bone_length)
+        # Length of every offset in one kernel; the root keeps a weight of 1
+        bone_length = torch.linalg.vector_norm(self._offsets, dim=-1)
+        return bone_length.masked_fill(self._is_root, 1.0)
 
     def joints_left(self):
         return self._joints_left
@@ -374,3 +351,17 @@ class Skeleton:
         for i, parent in enumerate(self._parents):
             if parent != -1:
                 self._children[parent].append(i)
+
+        # Tensors for the vectorized conversions: root mask, parent index (the
+        # root points at itself) and ancestors[i, k] = 1 if k is i or above it.
+        device = self._offsets.device
+        self._is_root = torch.as_tensor(self._parents == -1, device=device)
+        self._parent_index = torch.as_tensor(
+            np.where(self._parents == -1, np.arange(len(self._parents)), self._parents),
+            device=device,
+        )
+        ancestors = np.eye(len(self._parents), dtype=np.float32)
+        for i, parent in enumerate(self._parents):
+            if parent != -1:
+                ancestors[i] += ancestors[parent]
+        self._ancestors = torch.as_tensor(ancestors, device=device)
@@ -48,7 +48,6 @@ def test(opt, device):
     print(opt.data_path, opt.processed_data_dir, test_window)
     #ubisoft-laforge-animation-dataset/output/BVH
     lafan_dataset = CustomDataset(lafan_path="ubisoft-laforge-animation-dataset/output/Test_002_Dataset_Clean_BVH_rotations_only", processed_data_dir=opt.processed_data_dir, train=False, device=device, window=test_window)
-    total_data = lafan_dataset.data['global_pos'].shape[0]
     
     # Replace with noise to In-betweening Frames
     from_idx, target_idx = ckpt['from_idx'], ckpt['target_idx'] # default: 9-40, max: 48
@@ -64,8 +63,8 @@ def test(opt, device):
     rot_dim = lafan_dataset.num_joints * 4
     repr_dim = pos_dim + rot_dim
 
-    root_pos = torch.Tensor(lafan_dataset.data['root_p'][:, from_idx:target_idx+1]).to(device)
-    local_q = torch.Tensor(lafan_dataset.data['local_q'][:, from_idx:target_idx+1]).to(device)
+    root_pos = torch.from_numpy(np.array(lafan_dataset.data['root_p'][:, from_idx:target_idx+1], dtype=np.float32)).to(device, non_blocking=True)
+    local_q = torch.from_numpy(np.array(lafan_dataset.data['local_q'][:, from_idx:target_idx+1], dtype=np.float32)).to(device, non_blocking=True)
     local_q_normalized = nn.functional.normalize(local_q, p=2.0, dim=-1)
 
     # Replace testing inputs
@@ -94,12 +93,12 @@ def test(opt, device):
     else:
         raise ValueError('Invalid interpolation method')
     
-    pose_vectorized_input = pose_interpolated_input.permute(1,0,2)
+    pose_vectorized_input = pose_interpolated_input
 
     src_mask = torch.zeros((horizon, horizon), device=device).type(torch.bool)
     src_mask = src_mask.to(device)
 
-    seq_categories = [x[:-1] for x in lafan_dataset.data['seq_names']]
+    seq_categories = [x[:-1] for x in lafan_dataset.meta['seq_names']]
 
     le = LabelEncoder()
     le.classes_ = np.load(os.path.join(save_dir, 'le_classes_.npy'))
@@ -114,13 +113,16 @@ def test(opt, device):
     model.load_state_dict(ckpt['transformer_encoder_state_dict'])
     model.eval()
 
-    output, _ = model(pose_vectorized_input, src_mask, conditioning_labels)
+    # Only the windows in test_idx are visualized, so only those go through the
+    # model. Predictions are indexed by position in test_idx.
+    with torch.no_grad():
+        output, _ = model(pose_vectorized_input[test_idx], src_mask, conditioning_labels[test_idx])
 
-    pred_global_pos = output[1:,:,:pos_dim].permute(1,0,2).reshape(total_data,horizon-1,22,3)
+    pred_global_pos = output[:,1:,:pos_dim].reshape(len(test_idx),horizon-1,22,3)
     global_pos_unit_vec = skeleton_mocap.convert_to_unit_offset_mat(pred_global_pos)
     pred_global_pos = skeleton_mocap.convert_to_global_pos(global_pos_unit_vec).detach().numpy()
 
-    pred_global_rot = output[1:,:,pos_dim:].permute(1,0,2).reshape(total_data,horizon-1,22,4)
+    pred_global_rot = output[:,1:,pos_dim:].reshape(len(test_idx),horizon-1,22,4)
     pred_global_rot_normalized = nn.functional.normalize(pred_global_rot, p=2.0, dim=3).detach().numpy()
 
     clue = global_pos.clone().detach()
@@ -141,10 +143,10 @@ def test(opt, device):
         gt_stopover_pose = lafan_dataset.data['global_pos'][test_idx[i], from_idx + fixed]
 
         # Replace start/end with gt
-        pred_global_pos[test_idx[i], 0] = start_pose
+        pred_global_pos[i, 0] = start_pose
 
-        gpos = pred_global_pos[test_idx[i]]
-        grot = pred_global_rot_normalized[test_idx[i]]
+        gpos = pred_global_pos[i]
+        grot = pred_global_rot_normalized[i]
 
         local_quaternion_stopover, local_positions_stopover = quat_ik(stopover_rot.detach().numpy(), stopover_pose.detach().numpy(), parents=skeleton_mocap.parents())
         local_quaternion, local_positions = quat_ik(grot, gpos, parents=skeleton_mocap.parents())
@@ -167,7 +169,7 @@ def test(opt, device):
                 gt_img_path = os.path.join(save_path, 'gt_img')
 
                 plot_pose_with_stop(start_pose, input_pos[test_idx[i],t].reshape(lafan_dataset.num_joints, 3), target_pose, stopover_pose, t, skeleton_mocap, save_dir=input_img_path, prefix='input')
-                plot_pose_with_stop(start_pose, pred_global_pos[test_idx[i],t].reshape(lafan_dataset.num_joints, 3), target_pose, stopover_pose, t, skeleton_mocap, save_dir=pred_img_path, prefix='pred')
+                plot_pose_with_stop(start_pose, pred_global_pos[i,t].reshape(lafan_dataset.num_joints, 3), target_pose, stopover_pose, t, skeleton_mocap, save_dir=pred_img_path, prefix='pred')
                 plot_pose_with_stop(start_pose, lafan_dataset.data['global_pos'][test_idx[i], t+from_idx], target_pose, gt_stopover_pose, t, skeleton_mocap, save_dir=gt_img_path, prefix='gt')
 
                 input_img = Image.open(os.path.join(input_img_path, 'input'+str(t)+'.png'), 'r')
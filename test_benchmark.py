@@ -85,24 +85,19 @@ def test(opt, device):
     horizon = ckpt['horizon']
     print(f"HORIZON: {horizon}")
 
-    test_idx = []
-    for i in range(total_data):
-        test_idx.append(i)
-
     # Extract dimension from processed data
     pos_dim = lafan_dataset.num_joints * 3
     rot_dim = lafan_dataset.num_joints * 4
     repr_dim = pos_dim + rot_dim
 
-    root_pos = torch.Tensor(lafan_dataset.data['root_p'][:, from_idx:target_idx+1]).to(device)
-    local_q = torch.Tensor(lafan_dataset.data['local_q'][:, from_idx:target_idx+1]).to(device)
+    root_pos = torch.from_numpy(np.array(lafan_dataset.data['root_p'][:, from_idx:target_idx+1], dtype=np.float32)).to(device, non_blocking=True)
+    local_q = torch.from_numpy(np.array(lafan_dataset.data['local_q'][:, from_idx:target_idx+1], dtype=np.float32)).to(device, non_blocking=True)
     local_q_normalized = nn.functional.normalize(local_q, p=2.0, dim=-1)
 
     # Replace testing inputs
     fixed = 0
 
     global_pos, global_q = skeleton_mocap.forward_kinematics_with_rotation(local_q_normalized, root_pos)
-    global_pos[:,fixed] += torch.Tensor([0,0,0]).expand(global_pos.size(0),lafan_dataset.num_joints,3)
 
     interpolation = ckpt['interpolation']
 
@@ -123,7 +118,7 @@ def test(opt, device):
     else:
         raise ValueError('Invalid interpolation method')
     
-    pose_vectorized_input = pose_interpolated_input.permute(1,0,2)
+    pose_vectorized_input = pose_interpolated_input
 
     src_mask = torch.zeros((horizon, horizon), device=device).type(torch.bool)
     src_mask = src_mask.to(device)
@@ -136,69 +131,61 @@ def test(opt, device):
     model.load_state_dict(ckpt['transformer_encoder_state_dict'])
     model.eval()
 
-    l2p = []
-    l2q = []
-
-    pred_rot_npss = []
-    for i in range(len(test_idx)):
-        print(f"Processing ID: {test_idx[i]}")
-
-        seq_label = lafan_dataset.data['seq_names'][i][:-1]
-
-        if opt.dataset == 'LAFAN':
-            seq_label = [x[:-1] for x in lafan_dataset.data['seq_names']][i]
-        else:
-            seq_label = process_seq_names(lafan_dataset.data['seq_names'], dataset=opt.dataset)[i]
-
-        match_class = np.where(le.classes_ == seq_label)[0]
-        class_id = 0 if len(match_class) == 0 else match_class[0]
-
-        conditioning_label = torch.Tensor([[class_id]]).type(torch.int64).to(device)
-        cond_output, cond_gt = model(pose_vectorized_input[:, test_idx[i]:test_idx[i]+1, :], src_mask, conditioning_label)
-        print(f"Condition: {le.classes_[class_id]}")
-
-        output = cond_output
+    print(f"Processing {total_data} test windows")
 
-        pred_global_pos = output[1:,:,:pos_dim].permute(1,0,2).reshape(1,horizon-1,22,3)
-        global_pos_unit_vec = skeleton_mocap.convert_to_unit_offset_mat(pred_global_pos)
-        pred_global_pos = skeleton_mocap.convert_to_global_pos(global_pos_unit_vec).detach().numpy()
-
-        # Replace start/end with gt
-        gt_global_pos = lafan_dataset.data['global_pos'][test_idx[i]:test_idx[i]+1, from_idx:target_idx+1].reshape(1, -1, lafan_dataset.num_joints, 3)
-        pred_global_pos[0,0] = gt_global_pos[0,0] 
-        pred_global_pos[0,-1] = gt_global_pos[0,-1]
-
-        pred_global_rot = output[1:,:,pos_dim:].permute(1,0,2).reshape(1,horizon-1,22,4)
-        pred_global_rot_normalized = nn.functional.normalize(pred_global_rot, p=2.0, dim=3)
-        gt_global_rot = global_q[test_idx[i]:test_idx[i]+1]
-        pred_global_rot_normalized[0,0] = gt_global_rot[0,0]
-        pred_global_rot_normalized[0,-1] = gt_global_rot[0,-1]
-        pred_rot_npss.append(pred_global_rot_normalized)
-
-        # Normalize for L2P
-        normalized_gt_pos = torch.Tensor((lafan_dataset.data['global_pos'][test_idx[i]:test_idx[i]+1, from_idx:target_idx+1].reshape(1, -1, lafan_dataset.num_joints * 3).transpose(0,2,1) - x_mean) / x_std)
-        normalized_pred_pos = torch.Tensor((pred_global_pos.reshape(1, -1, lafan_dataset.num_joints * 3).transpose(0,2,1) - x_mean) / x_std)
-
-        l2p.append(torch.mean(torch.norm(normalized_pred_pos[0] - normalized_gt_pos[0], dim=(0))).item())
-        l2q.append(torch.mean(torch.norm(pred_global_rot_normalized[0] - global_q[test_idx[i]], dim=(1,2))).item())
-        print(f"ID {test_idx[i]}: test completed.")
-    
-    l2p_mean = np.mean(l2p)
-    l2q_mean = np.mean(l2q)
+    if opt.dataset == 'LAFAN':
+        seq_labels = [x[:-1] for x in lafan_dataset.meta['seq_names']]
+    else:
+        seq_labels = process_seq_names(lafan_dataset.meta['seq_names'], dataset=opt.dataset)
+
+    # Unknown labels fall back to class 0
+    class_index = {label: i for i, label in enumerate(le.classes_)}
+    class_ids = [class_index.get(label, 0) for label in seq_labels]
+
+    # Whole test set in one forward pass
+    conditioning_label = torch.tensor(class_ids, dtype=torch.int64, device=device).unsqueeze(1)
+    with torch.no_grad():
+        output, cond_gt = model(pose_vectorized_input, src_mask, conditioning_label)
+
+    pred_global_pos = output[:,1:,:pos_dim].reshape(total_data,horizon-1,22,3)
+    global_pos_unit_vec = skeleton_mocap.convert_to_unit_offset_mat(pred_global_pos)
+    pred_global_pos = skeleton_mocap.convert_to_global_pos(global_pos_unit_vec).detach().numpy()
+
+    # Replace start/end with gt
+    gt_global_pos = lafan_dataset.data['global_pos'][:, from_idx:target_idx+1]
+    pred_global_pos[:,0] = gt_global_pos[:,0]
+    pred_global_pos[:,-1] = gt_global_pos[:,-1]
+
+    pred_global_rot = output[:,1:,pos_dim:].reshape(total_data,horizon-1,22,4)
+    pred_global_rot_normalized = nn.functional.normalize(pred_global_rot, p=2.0, dim=3)
+    pred_global_rot_normalized[:,0] = global_q[:,0]
+    pred_global_rot_normalized[:,-1] = global_q[:,-1]
+
+    # Normalize for L2P
+    # Positions stay frame-major (N, T, F); the stats are transposed once to (1, 1, F)
+    pos_mean = x_mean.transpose(0,2,1)
+    pos_std = x_std.transpose(0,2,1)
+    normalized_gt_pos = torch.Tensor((gt_global_pos.reshape(total_data, -1, pos_dim) - pos_mean) / pos_std)
+    normalized_pred_pos = torch.Tensor((pred_global_pos.reshape(total_data, -1, pos_dim) - pos_mean) / pos_std)
+
+    # Every window has the same length, so the mean over all frames equals the
+    # mean of the per-window means.
+    l2p_mean = torch.mean(torch.norm(normalized_pred_pos - normalized_gt_pos, dim=2)).item()
+    l2q_mean = torch.mean(torch.norm(pred_global_rot_normalized - global_q, dim=(2,3))).item()
 
     # Drop end nodes for fair comparison
-    pred_quaternions = torch.cat(pred_rot_npss, dim=0)
+    pred_quaternions = pred_global_rot_normalized
     npss_gt = global_q[:,:,skeleton_mocap.has_children()].reshape(global_q.shape[0],global_q.shape[1], -1)
     npss_pred = pred_quaternions[:,:,skeleton_mocap.has_children()].reshape(pred_quaternions.shape[0],pred_quaternions.shape[1], -1)
     npss = benchmarks.npss(npss_gt, npss_pred).item()
 
-    print(f"TOTAL TEST DATA: {len(l2p)}")
+    print(f"TOTAL TEST DATA: {total_data}")
     print(f"L2P: {l2p_mean}")
     print(f"L2Q: {l2q_mean}")
     print(f"NPSS: {npss}")
 
     benchmark_out = {
-        'total_data': len(l2p),
+        'total_data': total_data,
         'L2P': l2p_mean,
         'L2Q': l2q_mean,
         'NPSS': npss
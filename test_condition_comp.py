@@ -71,17 +71,13 @@ def test(opt, device):
     horizon = ckpt['horizon']
     print(f"HORIZON: {horizon}")
 
-    test_idx = []
-    for i in range(total_data):
-        test_idx.append(i)
-
     # Extract dimension from processed data
     pos_dim = lafan_dataset.num_joints * 3
     rot_dim = lafan_dataset.num_joints * 4
     repr_dim = pos_dim + rot_dim
 
-    root_pos = torch.Tensor(lafan_dataset.data['root_p'][:, from_idx:target_idx+1]).to(device)
-    local_q = torch.Tensor(lafan_dataset.data['local_q'][:, from_idx:target_idx+1]).to(device)
+    root_pos = torch.from_numpy(np.array(lafan_dataset.data['root_p'][:, from_idx:target_idx+1], dtype=np.float32)).to(device, non_blocking=True)
+    local_q = torch.from_numpy(np.array(lafan_dataset.data['local_q'][:, from_idx:target_idx+1], dtype=np.float32)).to(device, non_blocking=True)
     local_q_normalized = nn.functional.normalize(local_q, p=2.0, dim=-1)
     global_pos, global_q = skeleton_mocap.forward_kinematics_with_rotation(local_q_normalized, root_pos)
 
@@ -105,15 +101,11 @@ def test(opt, device):
     else:
         raise ValueError('Invalid interpolation method')
     
-    pose_vectorized_input = pose_interpolated_input.permute(1,0,2)
+    pose_vectorized_input = pose_interpolated_input
 
     src_mask = torch.zeros((horizon, horizon), device=device).type(torch.bool)
     src_mask = src_mask.to(device)
 
-    seq_categories = [x[:-1] for x in lafan_dataset.data['seq_names']]
-
-    l1_loss = nn.L1Loss()
-
     le = LabelEncoder()
     le.classes_ = np.load(os.path.join(save_dir, 'le_classes_.npy'))
 
@@ -123,13 +115,26 @@ def test(opt, device):
 
     testing_motions = ['walk', 'run', 'dance', 'jumps', 'fight']
 
+    # Run every conditioning motion in a single forward pass: the input is tiled
+    # along the batch, one block per motion, and the output is split back.
+    motion_indices = [np.where(le.classes_ == cond_motion)[0][0] for cond_motion in testing_motions]
+    conditioning_label = torch.tensor(motion_indices, dtype=torch.int64, device=device).repeat_interleave(total_data).unsqueeze(1)
+    with torch.no_grad():
+        cond_outputs, _ = model(pose_vectorized_input.repeat(len(testing_motions), 1, 1), src_mask, conditioning_label)
+    cond_outputs = cond_outputs.chunk(len(testing_motions), dim=0)
+
+    # L2P works on frame-major (N, T, F) positions; the stats are transposed once
+    # to (1, 1, F) instead of transposing every position array. The ground truth
+    # is the same for every condition, so it is normalized once.
+    pos_mean = x_mean.transpose(0,2,1)
+    pos_std = x_std.transpose(0,2,1)
+    normalized_gt_pos = torch.Tensor((lafan_dataset.data['global_pos'][:, from_idx:target_idx+1].reshape(total_data, -1, pos_dim) - pos_mean) / pos_std)
+
     summary = {}
-    for cond_motion in testing_motions:
+    for cond_motion, cond_output in zip(testing_motions, cond_outputs):
         l2p = []
         l2q = []
 
-        pred_rot_npss = []
-
         print(f"GT: {gt_motion}")
         print(f"Condition: {cond_motion}")
         
@@ -138,14 +143,9 @@ def test(opt, device):
         bch_out['cond_motion'] = cond_motion
         bch_out['gt_motion'] = gt_motion
 
-        motion_index = np.where(le.classes_ == cond_motion)[0][0]
-
-        conditioning_label = torch.Tensor([[motion_index] * total_data]).type(torch.int64).to(device).permute(1,0)
-        cond_output, _ = model(pose_vectorized_input[:, :, :], src_mask, conditioning_label)
-
         output = cond_output
 
-        pred_global_pos = output[1:,:,:pos_dim].permute(1,0,2).reshape(total_data,horizon-1,22,3)
+        pred_global_pos = output[:,1:,:pos_dim].reshape(total_data,horizon-1,22,3)
         global_pos_unit_vec = skeleton_mocap.convert_to_unit_offset_mat(pred_global_pos)
         pred_global_pos = skeleton_mocap.convert_to_global_pos(global_pos_unit_vec).detach().numpy()
 
@@ -153,18 +153,16 @@ def test(opt, device):
         pred_global_pos[0,0] = gt_global_pos[0,0] 
         pred_global_pos[0,-1] = gt_global_pos[0,-1]
 
-        pred_global_rot = output[1:,:,pos_dim:].permute(1,0,2).reshape(total_data,horizon-1,22,4)
+        pred_global_rot = output[:,1:,pos_dim:].reshape(total_data,horizon-1,22,4)
         pred_global_rot_normalized = nn.functional.normalize(pred_global_rot, p=2.0, dim=3)
         gt_global_rot = global_q[:]
         pred_global_rot_normalized[0,0] = gt_global_rot[0,0]
         pred_global_rot_normalized[0,-1] = gt_global_rot[0,-1]
-        pred_rot_npss.append(pred_global_rot_normalized)
 
         # Normalize for L2P
-        normalized_gt_pos = torch.Tensor((lafan_dataset.data['global_pos'][:, from_idx:target_idx+1].reshape(total_data, -1, lafan_dataset.num_joints * 3).transpose(0,2,1) - x_mean) / x_std)
-        normalized_pred_pos = torch.Tensor((pred_global_pos.reshape(total_data, -1, lafan_dataset.num_joints * 3).transpose(0,2,1) - x_mean) / x_std)
+        normalized_pred_pos = torch.Tensor((pred_global_pos.reshape(total_data, -1, pos_dim) - pos_mean) / pos_std)
 
-        l2p.append(torch.mean(torch.norm(normalized_pred_pos - normalized_gt_pos, dim=(1))).item())
+        l2p.append(torch.mean(torch.norm(normalized_pred_pos - normalized_gt_pos, dim=2)).item())
         l2q.append(torch.mean(torch.norm(pred_global_rot_normalized - global_q, dim=(2,3))).item())
         
         l2p_mean = np.mean(l2p)
@@ -1,5 +1,7 @@
 import argparse
+import inspect
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -13,6 +15,7 @@ from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 
 from cmib.data.lafan1_dataset import CustomDataset
+from cmib.data.prefetcher import CudaPrefetcher
 from cmib.data.utils import flip_bvh, increment_path, process_seq_names
 from cmib.model.network import TransformerModel
 from cmib.model.preprocess import (lerp_input_repr, replace_constant,
@@ -20,6 +23,46 @@ from cmib.model.preprocess import (lerp_input_repr, replace_constant,
 from cmib.model.skeleton import (Skeleton, sk_joints_to_remove, sk_offsets, sk_parents, amass_offsets)
 
 
+def _cpu_copy(obj):
+    """
+    Copy every tensor of a (nested) checkpoint to the CPU, so that it can be
+    written in the background while training keeps updating the originals.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(v) for v in obj)
+    return obj
+
+
+def _save_atomic(obj, path, tmp_path):
+    """
+    torch.save to tmp_path, then move the file to path. Readers that pick the
+    newest file under weights/ never see a partially written checkpoint, as
+    long as tmp_path is outside that folder and on the same filesystem.
+    """
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class _Unmasked(nn.Module):
+    """
+    Run the transformer without an attention mask, taking only tensors. An
+    all-False mask tensor would make torch >= 2.0 test it for causality with a
+    host sync, which is not allowed while a CUDA graph is being captured, and
+    make_graphed_callables does not accept None arguments.
+    """
+
+    def __init__(self, model: TransformerModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, src: torch.Tensor, cond_code: torch.Tensor):
+        return self.model(src, None, cond_code)
+
+
 def train(opt, device):
 
     print(f"[DATASET: {opt.dataset}]")
@@ -40,7 +83,8 @@ def train(opt, device):
 
     # Load Skeleton
     offset = sk_offsets if opt.dataset == 'LAFAN' else amass_offsets
-    skeleton_mocap = Skeleton(offsets=offset, parents=sk_parents, device=device)
+    # Only used for the one-off FK below, which runs on the host
+    skeleton_mocap = Skeleton(offsets=offset, parents=sk_parents, device='cpu')
     skeleton_mocap.remove_joints(sk_joints_to_remove)
 
     # Flip, Load and preprocess data. It utilizes LAFAN1 utilities
@@ -50,7 +94,7 @@ def train(opt, device):
 
     # Load LAFAN Dataset
     Path(opt.processed_data_dir).mkdir(parents=True, exist_ok=True)
-    lafan_dataset = CustomDataset(lafan_path=opt.data_path, processed_data_dir=opt.processed_data_dir, train=True, device=device, window=opt.window, dataset=opt.dataset)
+    lafan_dataset = CustomDataset(lafan_path=opt.data_path, processed_data_dir=opt.processed_data_dir, train=True, device='cpu', window=opt.window, dataset=opt.dataset)
     #print(lafan_dataset.data["global_pos"].shape)
     from_idx, target_idx = opt.from_idx, opt.target_idx
     horizon = target_idx - from_idx + 1
@@ -59,28 +103,39 @@ def train(opt, device):
     print(f"Horizon with Conditioning: {horizon}")
     print(f"Interpolation Mode: {opt.interpolation}")
 
-    root_pos = torch.Tensor(lafan_dataset.data['root_p'][:, from_idx:target_idx+1]).to(device)
-    local_q = torch.Tensor(lafan_dataset.data['local_q'][:, from_idx:target_idx+1]).to(device)
+    # FK and vectorization run once on the host; only batches go to the device.
+    # The windows are copied out of the read-only memmaps once and wrapped as is.
+    root_pos = torch.from_numpy(np.array(lafan_dataset.data['root_p'][:, from_idx:target_idx+1], dtype=np.float32))
+    local_q = torch.from_numpy(np.array(lafan_dataset.data['local_q'][:, from_idx:target_idx+1], dtype=np.float32))
     local_q_normalized = nn.functional.normalize(local_q, p=2.0, dim=-1)
 
     global_pos, global_q = skeleton_mocap.forward_kinematics_with_rotation(local_q_normalized, root_pos)
     
-    global_pose_vec_gt = vectorize_representation(global_pos, global_q)
-    global_pose_vec_input = global_pose_vec_gt.clone().detach()
+    # Only one copy of the poses is kept: the interpolation input is cloned per batch
+    global_pose_vec = vectorize_representation(global_pos, global_q)
+    del root_pos, local_q, local_q_normalized, global_pos, global_q
 
     if opt.dataset == 'LAFAN':
-        seq_categories = [x[:-1] for x in lafan_dataset.data['seq_names']]
+        seq_categories = [x[:-1] for x in lafan_dataset.meta['seq_names']]
     else:
-        seq_categories = process_seq_names(lafan_dataset.data['seq_names'], dataset=opt.dataset)
+        seq_categories = process_seq_names(lafan_dataset.meta['seq_names'], dataset=opt.dataset)
 
     le = LabelEncoder()
     le_np = le.fit_transform(seq_categories)
-    seq_labels = torch.Tensor(le_np).type(torch.int64).unsqueeze(1).to(device)
+    seq_labels = torch.from_numpy(le_np.astype(np.int64)).unsqueeze(1)
     np.save(f'{save_dir}/le_classes_.npy', le.classes_)
-    num_labels = len(seq_labels.squeeze().unique())
-
-    tensor_dataset = TensorDataset(global_pose_vec_input, global_pose_vec_gt, seq_labels)
-    lafan_data_loader = DataLoader(tensor_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=0)
+    num_labels = len(le.classes_)
+
+    # Keep the training set in host memory. The loader collates each batch into a
+    # fresh tensor and pins it, so the copy to the device can overlap with the
+    # previous step.
+    tensor_dataset = TensorDataset(global_pose_vec, seq_labels)
+    # With --workers, worker processes assemble the next batches while the
+    # current step runs and are kept alive across epochs. Batches are loaded in
+    # the main process by default. A captured CUDA graph only replays for the
+    # batch size it was captured with.
+    loader_kwargs = {'persistent_workers': True, 'prefetch_factor': 2} if opt.workers > 0 else {}
+    lafan_data_loader = DataLoader(tensor_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=opt.workers, pin_memory=device.type == 'cuda', drop_last=opt.cuda_graph, **loader_kwargs)
 
     pos_dim = lafan_dataset.num_joints * 3
     rot_dim = lafan_dataset.num_joints * 4
@@ -90,88 +145,152 @@ def train(opt, device):
     transformer_encoder = TransformerModel(seq_len=horizon, d_model=repr_dim, nhead=nhead, d_hid=2048, nlayers=8, dropout=0.05, out_dim=repr_dim, num_labels=num_labels)
     transformer_encoder.to(device)
 
+    # Nothing is masked out of the attention. The wrapped and compiled modules
+    # share their parameters with transformer_encoder, which stays the one that
+    # is optimized and checkpointed.
+    model = _Unmasked(transformer_encoder)
+    if opt.compile:
+        if hasattr(torch, 'compile'):
+            model = torch.compile(model)
+        else:
+            print(f"torch.compile is not available in torch {torch.__version__}, training eagerly")
+    elif opt.jit:
+        model = torch.jit.script(model)
+
     l1_loss = nn.L1Loss()
-    optim = AdamW(params=transformer_encoder.parameters(), lr=opt.learning_rate)
-    scheduler = torch.optim.lr_scheduler.StepLR(optim, step_size=100, gamma=0.9)
+    # Update all parameters in one fused kernel when this torch version has it,
+    # otherwise with the multi-tensor (foreach) implementation.
+    optim_kwargs = {}
+    if device.type == 'cuda':
+        if 'fused' in inspect.signature(AdamW).parameters:
+            optim_kwargs['fused'] = True
+        else:
+            optim_kwargs['foreach'] = True
+    optim = AdamW(params=transformer_encoder.parameters(), lr=opt.learning_rate, **optim_kwargs)
+
+    # Mixed precision: bf16 where supported, otherwise fp16 with loss scaling.
+    # The scaler is a no-op unless fp16 autocast is on.
+    use_amp = opt.amp and device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
+
+    # Number of random masks trained per minibatch, and how many of them share
+    # one optimizer step
+    num_masks = 5
+    masks_per_step = num_masks if opt.tile_masks else 1
+
+    # The step has fixed shapes, so the model's forward and backward can be
+    # captured once as CUDA graphs and replayed. The loss, gradient clipping
+    # and optimizer step stay eager, so the LR decay and scaler work as usual.
+    use_cuda_graph = opt.cuda_graph and device.type == 'cuda' and type(model) is _Unmasked
+    if use_cuda_graph:
+        sample_args = (
+            torch.zeros((masks_per_step * opt.batch_size, horizon - 1, repr_dim), device=device),
+            torch.zeros((masks_per_step * opt.batch_size, 1), dtype=torch.int64, device=device),
+        )
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp, cache_enabled=False):
+            model = torch.cuda.make_graphed_callables(model, sample_args)
+    elif opt.cuda_graph:
+        print("CUDA graphs need a CUDA device and an eager model, training without them")
+
+    # Checkpoints are written by a background thread, one at a time
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
 
     for epoch in range(1, epochs + 1):
 
-        pbar = tqdm(lafan_data_loader, position=1, desc="Batch")
+        # Batches are copied to the device on a side stream one step ahead
+        pbar = tqdm(CudaPrefetcher(lafan_data_loader, device), position=1, desc="Batch")
 
-        recon_cond_loss = []
-        recon_pos_loss = []
-        recon_rot_loss = []
-        total_loss_list = []
-        #print('Total number of batches:', len(lafan_data_loader))
-        for minibatch_pose_input, minibatch_pose_gt, seq_label in pbar:
+        # Mask start frames for the whole epoch in one RNG call, five per minibatch
+        mask_start_frames = np.random.randint(0, horizon-1, size=(len(lafan_data_loader), num_masks))
 
-            for _ in range(5):
-                mask_start_frame = np.random.randint(0, horizon-1)
+        # Running sums of the condition, position, rotation and total losses
+        epoch_loss_sum = torch.zeros(4, device=device)
+        num_steps = 0
+        #print('Total number of batches:', len(lafan_data_loader))
+        for batch_idx, (minibatch_pose_gt, seq_label) in enumerate(pbar):
+            # Split the minibatch once; it is the same for all five masks
+            root_vec = minibatch_pose_gt[:,:,:pos_dim]
+            rot_vec = minibatch_pose_gt[:,:,pos_dim:]
+
+            # Every mask variant gets its own optimizer step. With --tile_masks the
+            # variants are stacked along the batch and trained in a single step
+            # instead: the loss is the mean of the per-mask losses, but an epoch
+            # makes num_masks times fewer optimizer updates.
+            pose_interpolated_inputs = []
+            for mask_start_frame in mask_start_frames[batch_idx].tolist():
 
                 if opt.interpolation == 'constant':
-                    pose_interpolated_input = replace_constant(minibatch_pose_input, mask_start_frame)
+                    pose_interpolated_input = replace_constant(minibatch_pose_gt, mask_start_frame)
                 elif opt.interpolation == 'slerp':
-                    root_vec = minibatch_pose_input[:,:,:pos_dim]
-                    rot_vec = minibatch_pose_input[:,:,pos_dim:]
                     root_lerped = lerp_input_repr(root_vec, mask_start_frame)
                     rot_slerped = slerp_input_repr(rot_vec, mask_start_frame)
                     pose_interpolated_input = torch.cat([root_lerped, rot_slerped], dim=2)
                 else:
                     raise ValueError('Invalid interpolation method')
 
-                pose_interpolated_input = pose_interpolated_input.permute(1,0,2)
+                pose_interpolated_inputs.append(pose_interpolated_input)
 
-                src_mask = torch.zeros((horizon, horizon), device=device).type(torch.bool)
-                src_mask = src_mask.to(device)
-                
-                output, cond_gt = transformer_encoder(pose_interpolated_input, src_mask, seq_label)
+            if opt.tile_masks:
+                pose_interpolated_inputs = [torch.cat(pose_interpolated_inputs, dim=0)]
+            seq_labels_tiled = seq_label.repeat(masks_per_step, 1)
 
-                cond_pred = output[0:1, :, :]
-                cond_loss = l1_loss(cond_pred, cond_gt)
-                recon_cond_loss.append(opt.loss_cond_weight * cond_loss)
+            for pose_interpolated_input in pose_interpolated_inputs:
 
-                pos_pred = output[1:,:,:pos_dim].permute(1,0,2)
-                pos_gt = minibatch_pose_gt[:,:,:pos_dim]
-                pos_loss = l1_loss(pos_pred, pos_gt)
-                recon_pos_loss.append(opt.loss_pos_weight * pos_loss)
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp, cache_enabled=not use_cuda_graph):
+                    output, cond_gt = model(pose_interpolated_input, seq_labels_tiled)
+                # Losses stay in fp32
+                output = output.float()
 
-                rot_pred = output[1:,:,pos_dim:].permute(1,0,2)
-                rot_pred_reshaped = rot_pred.reshape(rot_pred.shape[0], rot_pred.shape[1], lafan_dataset.num_joints, 4)
-                rot_pred_normalized = nn.functional.normalize(rot_pred_reshaped, p=2.0, dim=3)
+                cond_pred = output[:, 0:1, :]
+                cond_loss = l1_loss(cond_pred, cond_gt)
 
-                rot_gt = minibatch_pose_gt[:,:,pos_dim:]
-                rot_gt_reshaped = rot_gt.reshape(rot_gt.shape[0], rot_gt.shape[1], lafan_dataset.num_joints, 4)
-                rot_loss = l1_loss(rot_pred_reshaped, rot_gt_reshaped)
-                recon_rot_loss.append(opt.loss_rot_weight * rot_loss)
+                # (nB, T, D) -> (n, B, T, D) so the target broadcasts without copies.
+                # One absolute difference serves both the position and rotation L1.
+                pose_pred = output[:,1:,:]
+                pose_pred = pose_pred.reshape(masks_per_step, -1, *pose_pred.shape[1:])
+                abs_diff = (pose_pred - minibatch_pose_gt).abs()
+                pos_loss = abs_diff[..., :pos_dim].mean()
+                rot_loss = abs_diff[..., pos_dim:].mean()
 
                 total_g_loss = opt.loss_pos_weight * pos_loss + \
                                 opt.loss_rot_weight * rot_loss + \
                                 opt.loss_cond_weight * cond_loss
 
-                total_loss_list.append(total_g_loss)
-            
-                optim.zero_grad()
-                total_g_loss.backward()
+                epoch_loss_sum += torch.stack([
+                    opt.loss_cond_weight * cond_loss,
+                    opt.loss_pos_weight * pos_loss,
+                    opt.loss_rot_weight * rot_loss,
+                    total_g_loss,
+                ]).detach()
+                num_steps += 1
+
+                optim.zero_grad(set_to_none=True)
+                scaler.scale(total_g_loss).backward()
+                scaler.unscale_(optim)
                 torch.nn.utils.clip_grad_norm_(transformer_encoder.parameters(), 1.0, error_if_nonfinite=False)
-                optim.step()
-
-        scheduler.step()
-
-        # Log
-        log_dict = {
-            "Train/Loss/Condition Loss": torch.stack(recon_cond_loss).mean().item(), 
-            "Train/Loss/Position Loss": torch.stack(recon_pos_loss).mean().item(), 
-            "Train/Loss/Rotatation Loss": torch.stack(recon_rot_loss).mean().item(),
-            "Train/Loss/Total Loss": torch.stack(total_loss_list).mean().item(),
-        }
+                scaler.step(optim)
+                scaler.update()
+
+        # Step decay of the learning rate: x0.9 every 100 epochs
+        for param_group in optim.param_groups:
+            param_group['lr'] = opt.learning_rate * (0.9 ** (epoch // 100))
+
+        # Log. All epoch means come back to the host in a single sync.
+        epoch_losses = (epoch_loss_sum / num_steps).tolist()
+        log_dict = dict(zip([
+            "Train/Loss/Condition Loss",
+            "Train/Loss/Position Loss",
+            "Train/Loss/Rotatation Loss",
+            "Train/Loss/Total Loss",
+        ], epoch_losses))
         #wandb.log(log_dict)
 
         # Save model
         if (epoch % save_interval) == 0:
-            print("Train/Loss/Condition Loss" + str(torch.stack(recon_cond_loss).mean().item()))
-            print("Train/Loss/Position Loss" + str(torch.stack(recon_pos_loss).mean().item())) 
-            print("Train/Loss/Rotatation Loss" + str(torch.stack(recon_rot_loss).mean().item()))
-            print("Train/Loss/Total Loss" + str(torch.stack(total_loss_list).mean().item()))
+            for name, value in log_dict.items():
+                print(name + str(value))
             ckpt = {'epoch': epoch,
                     'transformer_encoder_state_dict': transformer_encoder.state_dict(),
                     'horizon': transformer_encoder.seq_len,
@@ -183,10 +302,16 @@ def train(opt, device):
                     'nlayers': transformer_encoder.nlayers,
                     'optimizer_state_dict': optim.state_dict(),
                     'interpolation': opt.interpolation,
-                    'loss': total_g_loss}
-            torch.save(ckpt, os.path.join(wdir, f'train-{epoch}.pt'))
+                    'loss': total_g_loss.item()}
+            if pending_save is not None:
+                pending_save.result()  # Re-raises if the previous save failed
+            pending_save = saver.submit(_save_atomic, _cpu_copy(ckpt), wdir / f'train-{epoch}.pt', save_dir / f'train-{epoch}.pt.tmp')
             print(f"[MODEL SAVED at {epoch} Epoch]")
 
+    saver.shutdown(wait=True)
+    if pending_save is not None:
+        pending_save.result()
+
     #wandb.run.finish()
     torch.cuda.empty_cache()
 
@@ -200,6 +325,7 @@ def parse_opt():
     parser.add_argument('--wandb_pj_name', type=str, default='cmib_train', help='project name')
     parser.add_argument('--batch_size', type=int, default=32, help='batch size')
     parser.add_argument('--epochs', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=0, help='dataloader worker processes (0: load in the main process)')
     parser.add_argument('--device', default='0', help='cuda device')
     parser.add_argument('--entity', default=None, help='W&B entity')
     parser.add_argument('--exp_name', default='exp', help='save to project/name')
@@ -211,6 +337,11 @@ def parse_opt():
     parser.add_argument('--from_idx', type=int, default=0, help='from idx')
     parser.add_argument('--target_idx', type=int, default=20, help='target idx')
     parser.add_argument('--interpolation', type=str, default='slerp', help='interpolation')
+    parser.add_argument('--amp', action='store_true', help='train with automatic mixed precision')
+    parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile')
+    parser.add_argument('--jit', action='store_true', help='script the model with TorchScript')
+    parser.add_argument('--cuda_graph', action='store_true', help='replay the forward/backward pass as CUDA graphs')
+    parser.add_argument('--tile_masks', action='store_true', help='train the masks of a minibatch in one stacked step instead of one step each')
     opt = parser.parse_args()
     return opt
 